@@ -4,11 +4,15 @@ Usage:
 python3 gen_model_answer.py --model-path lmsys/fastchat-t5-3b-v1.0 --model-id fastchat-t5-3b-v1.0
 """
 import argparse
-import json
+import concurrent.futures
+import inspect
+import logging
+import mmap
 import os
 import random
 import time
 
+import orjson
 import shortuuid
 import torch
 from tqdm import tqdm
@@ -18,6 +22,8 @@ from fastchat.model import load_model, get_conversation_template
 from fastchat.utils import str_to_torch_dtype
 from transformers import AutoTokenizer, T5Tokenizer, AutoConfig, AutoModelForCausalLM, LogitsProcessorList, LogitsProcessor
 
+logger = logging.getLogger(__name__)
+
 class StopAfterEosTextGenerated(LogitsProcessor):
         """Logits processor (to use with HuggingFace `generate()` method :
         https://huggingface.co/docs/transformers/v4.24.0/en/main_classes/
@@ -31,23 +37,136 @@ class StopAfterEosTextGenerated(LogitsProcessor):
             base_len (int): Size of the given context. Used to know if this is
                 the first character to generate.
             eos_token_id (int): ID of the EOS token.
+            vocab_size (int): Size of the vocabulary, used to preallocate the
+                forced-EOS score row.
+            device: Device the scores live on.
+            dtype: Dtype of the scores, so the forced-EOS write does not upcast.
         """
-        def __init__(self, base_len: int, eos_token_id: int):
+        def __init__(self, base_len: int, eos_token_id: int, vocab_size: int, device, dtype=torch.float32):
             super().__init__()
             self.base_len = base_len
             self.eos_token_id = eos_token_id
+            # Preallocate the constants once. `__call__` runs on every decoding
+            # step, so it must not allocate tensors or copy host->device there.
+            self.forced_eos = torch.full(
+                (vocab_size,), -float("inf"), device=device, dtype=dtype
+            )
+            self.forced_eos[eos_token_id] = 0
+            self.stop_token_ids = torch.tensor(
+                [15501, 281, 926], device=device, dtype=torch.long
+            )
 
         def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
-            if input_ids.size(1) > self.base_len:
-                forced_eos = torch.full((scores.size(1),), -float("inf")).to(scores.device)
-                forced_eos[self.eos_token_id] = 0 
-                
-                # If the last tokens of input_ids is the stop_token_ids, a eos will forced to generate sequencially
-                stop_token_ids = torch.Tensor([15501, 281, 926]).to(scores.device)
-                stop_sample_ids = torch.eq(input_ids[:, -len(stop_token_ids): ], stop_token_ids).all(dim=1)
-                scores[stop_sample_ids] = forced_eos
+            if input_ids.size(1) <= self.base_len:
+                return scores
+            # Cheap pre-check: the suffix can only match when the last token is
+            # the last stop token. Skip the vocab-sized write otherwise.
+            if not (input_ids[:, -1] == self.stop_token_ids[-1]).any():
+                return scores
+            # If the last tokens of input_ids is the stop_token_ids, a eos will forced to generate sequencially
+            stop_sample_ids = torch.eq(
+                input_ids[:, -self.stop_token_ids.size(0) :], self.stop_token_ids
+            ).all(dim=1)
+            scores[stop_sample_ids] = self.forced_eos
             return scores
         
+# Cache one automaton per conversation template name.
+_stop_automatons = {}
+
+
+def get_stop_automaton(conv, tokenizer):
+    """Build an Aho-Corasick automaton over the template's stop strings and
+    the tokenizer's special tokens, so the decoded output is scanned once
+    instead of once per pattern."""
+    if conv.name in _stop_automatons:
+        return _stop_automatons[conv.name]
+    import ahocorasick
+
+    if not conv.stop_str:
+        stop_strs = []
+    elif isinstance(conv.stop_str, str):
+        stop_strs = [conv.stop_str]
+    else:
+        stop_strs = list(conv.stop_str)
+
+    automaton = ahocorasick.Automaton()
+    for s in stop_strs:
+        automaton.add_word(s, (s, True))
+    for s in tokenizer.all_special_tokens:
+        if s and s not in stop_strs:
+            automaton.add_word(s, (s, False))
+    if len(automaton) > 0:
+        automaton.make_automaton()
+    else:
+        automaton = None
+    _stop_automatons[conv.name] = automaton
+    return automaton
+
+
+def truncate_and_clean_output(output, automaton):
+    """Truncate at the first stop-string hit and drop special-token spans,
+    scanning `output` only once.
+
+    Matches the old two-phase semantics: each stop string truncates at its
+    first occurrence, and only when that occurrence is not at index 0 (the
+    old `output.find(stop_str) > 0` test); special tokens never shadow a
+    stop-string match, since the old code searched stop strings before
+    removing them."""
+    if automaton is None:
+        return output
+    first_stop = {}
+    special_spans = []
+    for end_index, (word, is_stop) in automaton.iter(output):
+        start = end_index - len(word) + 1
+        if is_stop:
+            # iter() yields matches in position order, so the first hit per
+            # word is its first occurrence.
+            if word not in first_stop:
+                first_stop[word] = start
+        else:
+            special_spans.append((start, end_index + 1))
+
+    cut = min((s for s in first_stop.values() if s > 0), default=len(output))
+
+    pieces = []
+    prev_end = 0
+    for start, end in sorted(special_spans):
+        if start >= cut:
+            break
+        if start < prev_end:
+            # Overlaps a span that was already removed.
+            continue
+        pieces.append(output[prev_end:start])
+        prev_end = min(end, cut)
+    pieces.append(output[prev_end:cut])
+    return "".join(pieces)
+
+
+def configure_cuda_allocator():
+    """Tune the CUDA caching allocator for a long batch-inference run.
+
+    Called at the start of the answering worker rather than in `__main__`, so
+    it also applies inside the ray worker processes where the CUDA context of
+    a multi-GPU run actually lives.
+    """
+    # Let the allocator grow segments in place instead of fragmenting across
+    # variable-shape allocations, and keep large blocks from being split into
+    # unusable slivers. Must be set before the first CUDA allocation in this
+    # process.
+    os.environ.setdefault(
+        "PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512"
+    )
+    if torch.cuda.is_available():
+        # Cap the allocator below the full device so fragmentation does not
+        # creep into OOM over a long run, and reclaim cached blocks once 80%
+        # of that budget is used.
+        torch.cuda.set_per_process_memory_fraction(0.9)
+        if hasattr(torch.cuda.memory, "_set_allocator_settings"):
+            torch.cuda.memory._set_allocator_settings(
+                "garbage_collection_threshold:0.8"
+            )
+
+
 def run_eval(
     model_path,
     model_id,
@@ -62,6 +181,10 @@ def run_eval(
     max_gpu_memory,
     dtype,
     revision,
+    engine,
+    enable_torch_compile=False,
+    load_8bit=False,
+    quantization=None,
 ):
     questions = load_questions(question_file, question_begin, question_end)
     # random shuffle the questions to balance the loading
@@ -71,12 +194,40 @@ def run_eval(
     assert num_gpus_total % num_gpus_per_model == 0
     use_ray = num_gpus_total // num_gpus_per_model > 1
 
+    if engine == "vllm":
+        if use_ray:
+            # Dynamic scheduling: stream question batches through the vLLM
+            # replicas instead of handing each replica a fixed chunk, so fast
+            # replicas are not left idle behind a straggler shard.
+            run_eval_vllm_ray_data(
+                model_path,
+                model_id,
+                questions,
+                answer_file,
+                max_new_token,
+                num_choices,
+                num_gpus_per_model,
+                num_gpus_total,
+                dtype,
+                revision,
+                quantization=quantization,
+            )
+            return
+        answers_func = get_model_answers_vllm
+        extra_kwargs = {"quantization": quantization}
+    else:
+        answers_func = get_model_answers
+        extra_kwargs = {
+            "enable_torch_compile": enable_torch_compile,
+            "load_8bit": load_8bit,
+        }
+
     if use_ray:
         get_answers_func = ray.remote(num_gpus=num_gpus_per_model)(
-            get_model_answers
+            answers_func
         ).remote
     else:
-        get_answers_func = get_model_answers
+        get_answers_func = answers_func
 
     chunk_size = len(questions) // (num_gpus_total // num_gpus_per_model)
     ans_handles = []
@@ -93,6 +244,7 @@ def run_eval(
                 max_gpu_memory,
                 dtype=dtype,
                 revision=revision,
+                **extra_kwargs,
             )
         )
 
@@ -112,7 +264,10 @@ def get_model_answers(
     max_gpu_memory,
     dtype,
     revision,
+    enable_torch_compile=False,
+    load_8bit=False,
 ):
+    configure_cuda_allocator()
     model, tokenizer = load_model(
         model_path,
         revision=revision,
@@ -120,126 +275,439 @@ def get_model_answers(
         num_gpus=num_gpus_per_model,
         max_gpu_memory=max_gpu_memory,
         dtype=dtype,
-        load_8bit=False,
+        load_8bit=load_8bit,
         cpu_offloading=False,
         debug=False,
     )
-    verbose = True
+    # Decoding is memory-bandwidth bound: keep the weights (and thus the KV
+    # cache) in half precision so tensor-core paths are used and KV bytes are
+    # halved vs fp32. Quantized weights and an explicit float32 override are
+    # left alone.
+    if (
+        not load_8bit
+        and dtype != torch.float32
+        and next(model.parameters()).dtype
+        not in (torch.float16, torch.bfloat16)
+    ):
+        model = model.to(
+            dtype=torch.bfloat16
+            if torch.cuda.is_bf16_supported()
+            else torch.float16
+        )
+    torch.backends.cuda.matmul.allow_tf32 = True
+
+    # Bind loop-invariant attributes once; `model.device` and the tokenizer
+    # lookups are re-resolved attribute chains when left in the inner loop.
+    device = model.device
+
+    generate_kwargs = {}
+    # Inspect the original forward before torch.compile may wrap it.
+    forward_params = inspect.signature(model.forward).parameters
+    if enable_torch_compile:
+        # Small-batch decode is launch bound: capture the forward into CUDA
+        # graphs so each step is one graph replay instead of per-kernel Python
+        # dispatch. The stopping processor only uses preallocated tensor ops,
+        # so it does not break graph capture.
+        torch._inductor.config.triton.cudagraphs = True
+        model.forward = torch.compile(
+            model.forward, mode="reduce-overhead", fullgraph=False
+        )
+    static_cache = None
+    if not model.config.is_encoder_decoder and getattr(
+        model, "_supports_static_cache", False
+    ):
+        # Preallocate one max-shape KV cache and reuse it for every question,
+        # instead of letting each generate call cudaMalloc/cudaFree cache
+        # tensors sized to its own prompt. 2048 matches the context limit
+        # enforced below. Static shapes also keep compiled graphs reusable.
+        # Imported lazily: only present in transformers >= 4.38, and only
+        # models that declare _supports_static_cache get one.
+        from transformers import StaticCache
+
+        static_cache = StaticCache(
+            config=model.config,
+            max_batch_size=1,
+            max_cache_len=2048,
+            device=device,
+            dtype=model.dtype,
+        )
+        generate_kwargs["past_key_values"] = static_cache
+
+    # Only the last prompt position's logits are needed to start decoding;
+    # skip materializing the full [T, vocab] logits tensor at prefill. Only
+    # some architectures accept the kwarg (newer transformers renamed it
+    # logits_to_keep), so gate on the forward signature instead of passing it
+    # blindly and tripping generate's model-kwargs validation.
+    if "num_logits_to_keep" in forward_params:
+        generate_kwargs["num_logits_to_keep"] = 1
+    elif "logits_to_keep" in forward_params:
+        generate_kwargs["logits_to_keep"] = 1
+
+    # The template's stop tokens are constant per model; keep them on device
+    # once instead of pulling every generated id into Python for an `in` test.
+    template_stop_token_ids = get_conversation_template(model_id).stop_token_ids
+    if template_stop_token_ids:
+        stop_ids_t = torch.as_tensor(template_stop_token_ids, device=device)
+    else:
+        stop_ids_t = None
+
     MAX_NEW_TOKEN = max_new_token
-    for question in tqdm(questions):
-        if question["category"] in temperature_config:
-            temperature = temperature_config[question["category"]]
-        else:
-            temperature = 0.7
+    # Left padding keeps the prompt flush against the generated tokens, so a
+    # left-padded batch can be sliced per question and fed to `generate`.
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    eos_token_id = tokenizer.eos_token_id
+    pad_token_id = tokenizer.pad_token_id
 
-        choices = []
-        for i in range(num_choices):
-            torch.manual_seed(i)
-            conv = get_conversation_template(model_id)
-            turns = []
-            for j in range(len(question["turns"])):
-                qs = question["turns"][j]
-                conv.append_message(conv.roles[0], qs)
+    # Build the stopping processor once; only its `base_len` changes per prompt.
+    stop_processor = StopAfterEosTextGenerated(
+        0, eos_token_id, model.config.vocab_size, device, dtype=model.dtype
+    )
+    logits_processor = LogitsProcessorList([stop_processor])
+
+    # One persistent handle plus a single-thread writer keeps disk latency off
+    # the generation loop, instead of an open-append-close cycle per record.
+    # Unbuffered on purpose: each record goes out as one O_APPEND write of a
+    # full line, so the ray workers sharing this file cannot interleave
+    # mid-line the way a block-buffered flush can.
+    os.makedirs(os.path.dirname(answer_file), exist_ok=True)
+    fout = open(os.path.expanduser(answer_file), "ab", buffering=0)
+    writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    pending_writes = []
+
+    choices_per_question = [[] for _ in questions]
+    # The first-turn prompts are identical for every choice, so their batched
+    # tokenization is computed once and reused across choices.
+    first_turn_inputs = None
+    for i in range(num_choices):
+        # The turn-major order interleaves questions, but each question's
+        # sample stream must stay a fixed function of the choice seed, as in
+        # the old per-question loop: seed right before a question's first
+        # generate and carry its RNG state across its later turns, so sampled
+        # outputs do not depend on the question's position in the chunk.
+        rng_states = [None] * len(questions)
+        convs = [get_conversation_template(model_id) for _ in questions]
+        turns_per_question = [[] for _ in questions]
+
+        max_turns = max(len(q["turns"]) for q in questions)
+        for j in range(max_turns):
+            # Collect the pending prompts of this turn across all questions
+            # and tokenize them with a single batched tokenizer call.
+            indices = []
+            prompts = []
+            for k, question in enumerate(questions):
+                if j >= len(question["turns"]):
+                    continue
+                conv = convs[k]
+                conv.append_message(conv.roles[0], question["turns"][j])
                 conv.append_message(conv.roles[1], None)
-                prompt = conv.get_prompt()
-                
-                inputs = tokenizer([prompt],
-                                   split_special_tokens=False,
-                                   return_tensors="pt")
-                input_ids = inputs.input_ids.to(model.device)
-                attention_mask = inputs.attention_mask.to(model.device)
-                base_len = inputs.input_ids.size(-1)
-                logits_processor = LogitsProcessorList([StopAfterEosTextGenerated(base_len, tokenizer.eos_token_id)])
-
-                num_input_tokens = inputs.input_ids.size(-1)
-                if verbose:
-                    print('Text Input: \n', prompt)
-                    print("Input Tokens:\n", input_ids)
-                    print("Attention Mask:\n", attention_mask)
-                print("Num of Input Tokens: ", num_input_tokens)
+                indices.append(k)
+                prompts.append(conv.get_prompt())
+
+            if j == 0 and first_turn_inputs is not None:
+                input_ids_batch, attention_mask_batch = first_turn_inputs
+            else:
+                inputs = tokenizer(
+                    prompts,
+                    padding=True,
+                    split_special_tokens=False,
+                    return_tensors="pt",
+                )
+                input_ids_batch = inputs.input_ids
+                attention_mask_batch = inputs.attention_mask
+                if device.type == "cuda":
+                    # Pin the whole batch once so the per-question slices can
+                    # be copied host->device asynchronously below.
+                    input_ids_batch = input_ids_batch.pin_memory()
+                    attention_mask_batch = attention_mask_batch.pin_memory()
+                if j == 0:
+                    first_turn_inputs = (input_ids_batch, attention_mask_batch)
+
+            for pos, k in enumerate(tqdm(indices)):
+                question = questions[k]
+                conv = convs[k]
+                prompt = prompts[pos]
+                if question["category"] in temperature_config:
+                    temperature = temperature_config[question["category"]]
+                else:
+                    temperature = 0.7
+
+                # Trim this row's left padding: the real tokens are the
+                # rightmost `row_len`, and keeping the padded width would make
+                # base_len and the context-limit check below see the longest
+                # prompt of the whole batch instead of this question's. The
+                # trailing slices are still views into pinned memory.
+                row_len = int(attention_mask_batch[pos].sum())
+                # The two copies are queued back to back and overlap with the
+                # Python work before generate; generate's first kernel is on
+                # the same stream, so no explicit synchronization is needed.
+                input_ids = input_ids_batch[pos : pos + 1, -row_len:].to(
+                    device, non_blocking=True
+                )
+                attention_mask = attention_mask_batch[pos : pos + 1, -row_len:].to(
+                    device, non_blocking=True
+                )
+                base_len = input_ids.size(-1)
+                stop_processor.base_len = base_len
+
+                num_input_tokens = input_ids.size(-1)
+                # Materializing tensor contents forces a D2H copy, so only do
+                # it when debug logging is actually on.
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Text Input:\n%s", prompt)
+                    logger.debug("Input Tokens:\n%s", input_ids)
+                    logger.debug("Attention Mask:\n%s", attention_mask)
+                logger.debug("Num of Input Tokens: %d", num_input_tokens)
                 if num_input_tokens + MAX_NEW_TOKEN > 2048:
                     max_new_token = 2048 - num_input_tokens
-                    print(f'max_new_token is reduced to {max_new_token} because of the limit of max context length 2048 and the input token {num_input_tokens}' )
+                    logger.warning(
+                        "max_new_token is reduced to %d because of the limit of "
+                        "max context length 2048 and the input token %d",
+                        max_new_token,
+                        num_input_tokens,
+                    )
                 else:
                     max_new_token = MAX_NEW_TOKEN
                 if temperature < 1e-4:
                     do_sample = False
                 else:
                     do_sample = True
-                
+
+                if do_sample:
+                    if rng_states[k] is None:
+                        torch.manual_seed(i)
+                    else:
+                        cpu_state, cuda_states = rng_states[k]
+                        torch.set_rng_state(cpu_state)
+                        if cuda_states is not None:
+                            torch.cuda.set_rng_state_all(cuda_states)
+
                 # some models may error out when generating long outputs
                 try:
+                    if static_cache is not None:
+                        static_cache.reset()
                     output_ids = model.generate(
                         input_ids=input_ids,
                         attention_mask=attention_mask,
-                        bos_token_id=tokenizer.pad_token_id,
-                        eos_token_id=tokenizer.eos_token_id,
-                        pad_token_id=tokenizer.pad_token_id,
+                        bos_token_id=pad_token_id,
+                        eos_token_id=eos_token_id,
+                        pad_token_id=pad_token_id,
                         do_sample=do_sample,
                         temperature=temperature,
                         max_new_tokens=max_new_token,
                         logits_processor=logits_processor,
+                        **generate_kwargs,
                     )
-                    
+
                     if model.config.is_encoder_decoder:
                         output_ids = output_ids[0]
                     else:
                         output_ids = output_ids[0][len(input_ids[0]) :]
-                    
-                    print("Num of Generated Tokens: ", output_ids.size(-1))
+
+                    logger.debug("Num of Generated Tokens: %d", output_ids.size(-1))
                     # be consistent with the template's stop_token_ids
-                    if conv.stop_token_ids:
-                        stop_token_ids_index = [
-                            i
-                            for i, id in enumerate(output_ids)
-                            if id in conv.stop_token_ids
-                        ]
-                        if len(stop_token_ids_index) > 0:
-                            output_ids = output_ids[: stop_token_ids_index[0]]
-                    
+                    if stop_ids_t is not None:
+                        hits = torch.isin(output_ids, stop_ids_t).nonzero(
+                            as_tuple=False
+                        )
+                        if hits.numel():
+                            output_ids = output_ids[: hits[0].item()]
+
                     output = tokenizer.decode(
                         output_ids,
                         spaces_between_special_tokens=False,
                     )
-                    if conv.stop_str and isinstance(conv.stop_str, list):
-                        stop_str_indices = sorted(
-                            [
-                                output.find(stop_str)
-                                for stop_str in conv.stop_str
-                                if output.find(stop_str) > 0
-                            ]
-                        )
-                        if len(stop_str_indices) > 0:
-                            output = output[: stop_str_indices[0]]
-                    elif conv.stop_str and output.find(conv.stop_str) > 0:
-                        output = output[: output.find(conv.stop_str)]
-
-                    for special_token in tokenizer.special_tokens_map.values():
-                        if isinstance(special_token, list):
-                            for special_tok in special_token:
-                                output = output.replace(special_tok, "")
-                        else:
-                            output = output.replace(special_token, "")
+                    output = truncate_and_clean_output(
+                        output, get_stop_automaton(conv, tokenizer)
+                    )
                     output = output.strip()
-                    
+
                     if conv.name == "xgen" and output.startswith("Assistant:"):
                         output = output.replace("Assistant:", "", 1).strip()
-                    if verbose:
-                        print("Generated Tokens:\n", output_ids)
-                        print("Generated Text:\n", output)
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("Generated Tokens:\n%s", output_ids)
+                        logger.debug("Generated Text:\n%s", output)
                 except RuntimeError as e:
-                    print(e)
-                    print("ERROR question ID: ", question["question_id"])
+                    logger.error("%s\nERROR question ID: %s", e, question["question_id"])
                     output = "ERROR"
 
+                if do_sample:
+                    rng_states[k] = (
+                        torch.get_rng_state(),
+                        torch.cuda.get_rng_state_all()
+                        if torch.cuda.is_available()
+                        else None,
+                    )
+
                 conv.update_last_message(output)
-                turns.append(output)
+                turns_per_question[k].append(output)
 
-            choices.append({"index": i, "turns": turns})
+                if j == len(question["turns"]) - 1:
+                    # Append this question's record as soon as its last turn
+                    # finishes, so a mid-run failure keeps everything answered
+                    # so far -- the same granularity as the old per-question
+                    # appends. With num_choices > 1 the earlier, shorter
+                    # records are superseded by reorg_answer_file's keep-last
+                    # de-duplication.
+                    choices_per_question[k].append(
+                        {"index": i, "turns": turns_per_question[k]}
+                    )
+                    ans_json = {
+                        "question_id": question["question_id"],
+                        "answer_id": shortuuid.uuid(),
+                        "model_id": model_id,
+                        "choices": choices_per_question[k],
+                        "tstamp": time.time(),
+                    }
+                    pending_writes.append(
+                        writer.submit(fout.write, orjson.dumps(ans_json) + b"\n")
+                    )
+
+    # Surface background write errors instead of dropping them.
+    for future in pending_writes:
+        future.result()
+    writer.shutdown(wait=True)
+    fout.close()
+
+
+def generate_answers_vllm(llm, model_id, questions, max_new_token, num_choices):
+    """Generate the answer choices for `questions` on an existing vLLM engine.
+
+    All questions of a turn are submitted to `llm.generate` as one batch so
+    the engine can interleave them with continuous batching, instead of
+    running one `model.generate` per prompt. Returns one list of choices per
+    question.
+    """
+    from vllm import SamplingParams
 
-        # Dump answers
-        os.makedirs(os.path.dirname(answer_file), exist_ok=True)
-        with open(os.path.expanduser(answer_file), "a") as fout:
+    def make_sampling_params(question, conv, n):
+        if question["category"] in temperature_config:
+            temperature = temperature_config[question["category"]]
+        else:
+            temperature = 0.7
+        return SamplingParams(
+            n=n,
+            temperature=temperature,
+            max_tokens=max_new_token,
+            stop=[conv.stop_str] if isinstance(conv.stop_str, str) else conv.stop_str,
+            stop_token_ids=conv.stop_token_ids,
+        )
+
+    def clean_output(conv, output):
+        output = output.strip()
+        if conv.name == "xgen" and output.startswith("Assistant:"):
+            output = output.replace("Assistant:", "", 1).strip()
+        return output
+
+    convs_per_choice = [
+        [get_conversation_template(model_id) for _ in questions]
+        for _ in range(num_choices)
+    ]
+    turns_per_choice = [[[] for _ in questions] for _ in range(num_choices)]
+
+    # The first turn is identical across choices, so submit each prompt once
+    # with `n=num_choices` and let the engine share its prefill KV cache
+    # between the sampled completions.
+    prompts = []
+    sampling_params = []
+    for k, question in enumerate(questions):
+        for i in range(num_choices):
+            conv = convs_per_choice[i][k]
+            conv.append_message(conv.roles[0], question["turns"][0])
+            conv.append_message(conv.roles[1], None)
+        conv = convs_per_choice[0][k]
+        prompts.append(conv.get_prompt())
+        sampling_params.append(make_sampling_params(question, conv, num_choices))
+
+    outputs = llm.generate(prompts, sampling_params)
+    for k, request_output in enumerate(outputs):
+        for i in range(num_choices):
+            conv = convs_per_choice[i][k]
+            output = clean_output(conv, request_output.outputs[i].text)
+            conv.update_last_message(output)
+            turns_per_choice[i][k].append(output)
+
+    # Later turns diverge per choice; batch them per (choice, turn) so the
+    # engine still sees all questions of a turn at once.
+    max_turns = max(len(q["turns"]) for q in questions)
+    for i in range(num_choices):
+        convs = convs_per_choice[i]
+        turns_per_question = turns_per_choice[i]
+        for j in range(1, max_turns):
+            indices = []
+            prompts = []
+            sampling_params = []
+            for k, question in enumerate(questions):
+                if j >= len(question["turns"]):
+                    continue
+                conv = convs[k]
+                conv.append_message(conv.roles[0], question["turns"][j])
+                conv.append_message(conv.roles[1], None)
+                indices.append(k)
+                prompts.append(conv.get_prompt())
+                sampling_params.append(make_sampling_params(question, conv, 1))
+
+            outputs = llm.generate(prompts, sampling_params)
+            for k, request_output in zip(indices, outputs):
+                conv = convs[k]
+                output = clean_output(conv, request_output.outputs[0].text)
+                conv.update_last_message(output)
+                turns_per_question[k].append(output)
+
+    choices_per_question = [
+        [
+            {"index": i, "turns": turns_per_choice[i][k]}
+            for i in range(num_choices)
+        ]
+        for k in range(len(questions))
+    ]
+    return choices_per_question
+
+
+def vllm_dtype(dtype, quantization):
+    """Map the torch dtype to vLLM's dtype string.
+
+    AWQ/GPTQ kernels reject bfloat16, so with quantization enabled the engine
+    is left to pick the dtype the checkpoint supports.
+    """
+    if quantization is not None or dtype is None:
+        return "auto"
+    return str(dtype).replace("torch.", "")
+
+
+def get_model_answers_vllm(
+    model_path,
+    model_id,
+    questions,
+    answer_file,
+    max_new_token,
+    num_choices,
+    num_gpus_per_model,
+    max_gpu_memory,
+    dtype,
+    revision,
+    quantization=None,
+):
+    """Generate answers with a single vLLM engine and dump them."""
+    from vllm import LLM
+
+    llm = LLM(
+        model=model_path,
+        revision=revision,
+        dtype=vllm_dtype(dtype, quantization),
+        tensor_parallel_size=num_gpus_per_model,
+        quantization=quantization,
+    )
+
+    choices_per_question = generate_answers_vllm(
+        llm, model_id, questions, max_new_token, num_choices
+    )
+
+    # Dump answers
+    os.makedirs(os.path.dirname(answer_file), exist_ok=True)
+    with open(os.path.expanduser(answer_file), "ab") as fout:
+        for question, choices in zip(questions, choices_per_question):
             ans_json = {
                 "question_id": question["question_id"],
                 "answer_id": shortuuid.uuid(),
@@ -247,21 +715,112 @@ def get_model_answers(
                 "choices": choices,
                 "tstamp": time.time(),
             }
-            fout.write(json.dumps(ans_json) + "\n")
+            fout.write(orjson.dumps(ans_json) + b"\n")
+
+
+def run_eval_vllm_ray_data(
+    model_path,
+    model_id,
+    questions,
+    answer_file,
+    max_new_token,
+    num_choices,
+    num_gpus_per_model,
+    num_gpus_total,
+    dtype,
+    revision,
+    quantization=None,
+):
+    """Stream questions through vLLM replicas with Ray Data.
+
+    Unlike the fixed `chunk_size` sharding, `map_batches` hands out small
+    question batches to whichever replica is free, so uneven generation
+    lengths no longer leave GPUs idle behind a straggler shard.
+    """
+    import ray.data
+
+    if num_gpus_per_model != 1:
+        # The map_batches actor reserves its GPUs up front; with
+        # tensor_parallel_size > 1 vLLM then tries to place its own Ray TP
+        # workers on GPUs the actor already holds and the placement deadlocks.
+        raise ValueError(
+            "--engine vllm with multiple replicas requires "
+            "--num-gpus-per-model 1. For tensor parallelism, run a single "
+            "replica (--num-gpus-total equal to --num-gpus-per-model)."
+        )
+
+    num_replicas = num_gpus_total // num_gpus_per_model
+
+    class VLLMAnswerBatch:
+        def __init__(self):
+            from vllm import LLM
+
+            self.llm = LLM(
+                model=model_path,
+                revision=revision,
+                dtype=vllm_dtype(dtype, quantization),
+                tensor_parallel_size=num_gpus_per_model,
+                quantization=quantization,
+            )
+
+        def __call__(self, batch):
+            batch_questions = [orjson.loads(q) for q in batch["question"]]
+            choices_per_question = generate_answers_vllm(
+                self.llm, model_id, batch_questions, max_new_token, num_choices
+            )
+            answers = []
+            for question, choices in zip(batch_questions, choices_per_question):
+                ans_json = {
+                    "question_id": question["question_id"],
+                    "answer_id": shortuuid.uuid(),
+                    "model_id": model_id,
+                    "choices": choices,
+                    "tstamp": time.time(),
+                }
+                answers.append(orjson.dumps(ans_json).decode())
+            return {"answer": answers}
+
+    ds = ray.data.from_items(
+        [{"question": orjson.dumps(q).decode()} for q in questions]
+    )
+    ds = ds.repartition(num_replicas * 4)
+    ds = ds.map_batches(
+        VLLMAnswerBatch,
+        concurrency=num_replicas,
+        num_gpus=num_gpus_per_model,
+        # ~4 batches per replica so scheduling stays dynamic.
+        batch_size=max(1, len(questions) // (num_replicas * 4)),
+    )
+
+    os.makedirs(os.path.dirname(answer_file), exist_ok=True)
+    with open(os.path.expanduser(answer_file), "a") as fout:
+        for row in ds.iter_rows():
+            fout.write(row["answer"] + "\n")
 
 
 def reorg_answer_file(answer_file):
     """Sort by question id and de-duplication"""
-    answers = {}
-    with open(answer_file, "r") as fin:
-        for l in fin:
-            qid = json.loads(l)["question_id"]
-            answers[qid] = l
+    # Index (offset, length) per question id instead of holding every line in
+    # memory, then re-emit the sorted byte slices straight from an mmap of the
+    # original file -- no re-parse, no per-line buffering on rewrite.
+    index = {}
+    offset = 0
+    with open(answer_file, "rb") as fin:
+        for line in fin:
+            qid = orjson.loads(line)["question_id"]
+            index[qid] = (offset, len(line))
+            offset += len(line)
 
-    qids = sorted(list(answers.keys()))
-    with open(answer_file, "w") as fout:
-        for qid in qids:
-            fout.write(answers[qid])
+    if not index:
+        return
+    tmp_file = answer_file + ".tmp"
+    with open(answer_file, "rb") as fin, open(tmp_file, "wb") as fout:
+        mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        for qid in sorted(index):
+            off, length = index[qid]
+            fout.write(mm[off : off + length])
+        mm.close()
+    os.replace(tmp_file, answer_file)
 
 
 if __name__ == "__main__":
@@ -314,13 +873,17 @@ if __name__ == "__main__":
     parser.add_argument(
         "--max-gpu-memory",
         type=str,
-        help="Maxmum GPU memory used for model weights per GPU.",
+        help="Maxmum GPU memory used for model weights per GPU. This caps "
+        "weight placement only; each answering worker additionally limits "
+        "the CUDA caching allocator to 90%% of its device.",
     )
     parser.add_argument(
         "--dtype",
         type=str,
         choices=["float32", "float16", "bfloat16"],
-        help="Override the default dtype. If not set, it will use float16 on GPU and float32 on CPU.",
+        help="Override the default dtype. If not set, fp32 checkpoints are "
+        "cast after load to bfloat16 where the GPU supports it and float16 "
+        "otherwise.",
         default=None,
     )
     parser.add_argument(
@@ -329,9 +892,48 @@ if __name__ == "__main__":
         default="main",
         help="The model revision to load.",
     )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Log prompts, token ids and outputs at debug level. Off by "
+        "default: printing tensors on every turn stalls the decode loop.",
+    )
+    parser.add_argument(
+        "--torch-compile",
+        action="store_true",
+        help="Compile the model forward with torch.compile "
+        "(mode='reduce-overhead') to cut per-step launch overhead. "
+        "Only used by the hf engine.",
+    )
+    parser.add_argument(
+        "--load-8bit",
+        action="store_true",
+        help="Load the model in 8-bit (bitsandbytes). Halves the weight "
+        "bandwidth that dominates decode. Only used by the hf engine.",
+    )
+    parser.add_argument(
+        "--quantization",
+        type=str,
+        choices=["awq", "gptq", "squeezellm"],
+        default=None,
+        help="Weight quantization for the vllm engine.",
+    )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        choices=["hf", "vllm"],
+        default="hf",
+        help="The inference engine. `vllm` batches all questions through "
+        "continuous batching; `hf` keeps the original per-question loop.",
+    )
 
     args = parser.parse_args()
 
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format="%(asctime)s | %(levelname)s | %(message)s",
+    )
+
     if args.num_gpus_total // args.num_gpus_per_model > 1:
         import ray
 
@@ -359,6 +961,10 @@ if __name__ == "__main__":
         max_gpu_memory=args.max_gpu_memory,
         dtype=str_to_torch_dtype(args.dtype),
         revision=args.revision,
+        engine=args.engine,
+        enable_torch_compile=args.torch_compile,
+        load_8bit=args.load_8bit,
+        quantization=args.quantization,
     )
 
     reorg_answer_file(answer_file)